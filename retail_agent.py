@@ -11,25 +11,32 @@ from __future__ import annotations
 import argparse
 import csv
 import math
+import os
 import random
 import statistics
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
+from functools import partial
+from itertools import islice
 from pathlib import Path
-from typing import List, Optional
-
-
-SERVICE_Z = {
-    0.80: 0.84,
-    0.85: 1.04,
-    0.90: 1.28,
-    0.95: 1.65,
-    0.97: 1.88,
-    0.99: 2.33,
-}
+from typing import List, Optional, Sequence, Tuple
 
 
 @dataclass
 class ReplenishmentDecision:
+    # Sem __dict__ por instância; como os campos não têm valor padrão, os
+    # slots podem ser declarados à mão (compatível com Python < 3.10).
+    __slots__ = (
+        "forecast_demand",
+        "demand_std",
+        "estimated_lead_time_days",
+        "safety_stock",
+        "reorder_point",
+        "target_stock",
+        "recommended_order_qty",
+    )
+
     forecast_demand: float
     demand_std: float
     estimated_lead_time_days: float
@@ -39,6 +46,81 @@ class ReplenishmentDecision:
     recommended_order_qty: int
 
 
+def _mean_m2(values: Sequence[float]) -> Tuple[float, float]:
+    """Média e soma dos quadrados dos desvios, em duas passadas.
+
+    A média é deslocada pelo primeiro valor, de modo que uma janela constante
+    dá exatamente ``(valor, 0.0)``.
+    """
+    shift = values[0]
+    mean = shift + math.fsum(v - shift for v in values) / len(values)
+    return mean, math.fsum((v - mean) * (v - mean) for v in values)
+
+
+def _two_pass_std(values: Sequence[float]) -> float:
+    """Desvio padrão populacional de ``values`` sem estado incremental."""
+    n = len(values)
+    if n < 2:
+        return 0.0
+    return math.sqrt(_mean_m2(values)[1] / n)
+
+
+class _RollingWindow:
+    """Janela móvel com média e soma dos quadrados dos desvios (Welford).
+
+    Permite obter o desvio padrão populacional dos últimos ``size`` valores
+    em O(1), sem percorrer a janela de novo a cada consulta. A atualização de
+    Welford (também na troca do valor mais antigo) evita o cancelamento de
+    ``sumsq / n - mean**2`` quando a média é grande perto da dispersão.
+
+    A troca do valor mais antigo deixa resíduo de arredondamento em ``_m2``;
+    por isso a janela é recalculada exatamente a cada ``size`` inserções, e
+    zerada quando todos os valores ficam iguais (um desvio espúrio ali vira
+    estoque de segurança positivo e muda o pedido).
+    """
+
+    def __init__(self, size: Optional[int]) -> None:
+        self.values: deque[float] = deque(maxlen=size)
+        self._mean = 0.0
+        self._m2 = 0.0
+        self._equal_run = 0  # valores iguais consecutivos no fim da janela
+        self._since_resync = 0
+
+    def push(self, value: float) -> None:
+        values = self.values
+        self._equal_run = self._equal_run + 1 if values and values[-1] == value else 1
+        mean = self._mean
+        if len(values) == values.maxlen:
+            old = values[0]
+            values.append(value)
+            delta = value - old
+            new_mean = mean + delta / len(values)
+            self._m2 += delta * (value - new_mean + old - mean)
+            self._since_resync += 1
+        else:
+            values.append(value)
+            delta = value - mean
+            new_mean = mean + delta / len(values)
+            self._m2 += delta * (value - new_mean)
+        self._mean = new_mean
+
+        if self._equal_run >= len(values):
+            self._mean = value
+            self._m2 = 0.0
+        elif self._since_resync >= len(values):
+            self._resync()
+
+    def _resync(self) -> None:
+        self._mean, self._m2 = _mean_m2(self.values)
+        self._since_resync = 0
+
+    def std(self) -> float:
+        n = len(self.values)
+        if n < 2:
+            return 0.0
+        return math.sqrt(max(0.0, self._m2 / n))
+
+
 class RetailDecisionAgent:
     """Agente de reposição com previsão + política de estoque de segurança.
 
@@ -54,26 +136,53 @@ class RetailDecisionAgent:
         alpha: float = 0.35,
         demand_window: int = 28,
     ) -> None:
-        if service_level not in SERVICE_Z:
-            valid = ", ".join(str(k) for k in sorted(SERVICE_Z))
-            raise ValueError(f"service_level inválido. Use um de: {valid}")
+        if not 0.0 < service_level < 1.0:
+            raise ValueError("service_level inválido. Use um valor entre 0 e 1 (exclusivo).")
         self.service_level = service_level
         self.review_period_days = review_period_days
         self.alpha = alpha
         self.demand_window = demand_window
+        self._z = statistics.NormalDist().inv_cdf(service_level)
 
-    def _exp_smoothing_forecast(self, history: List[float]) -> float:
+    def _exp_smoothing_forecast(self, history: Sequence[float]) -> float:
+        # Recorrência da esquerda para a direita: uma soma ponderada
+        # equivalente muda o arredondamento, e o ``ceil`` da quantidade pedida
+        # pode transformar essa diferença em uma unidade a mais.
         if not history:
             return 0.0
+        alpha = self.alpha
+        decay = 1 - alpha
         level = history[0]
-        for value in history[1:]:
-            level = self.alpha * value + (1 - self.alpha) * level
+        for value in islice(history, 1, None):
+            level = alpha * value + decay * level
         return max(0.0, level)
 
-    def _recent_std(self, history: List[float]) -> float:
-        if len(history) < 2:
-            return 0.0
-        return statistics.pstdev(history)
+    def _recent_std(self, history: Sequence[float]) -> float:
+        return _two_pass_std(history)
+
+    def _rolling_estimates(
+        self, demand: Sequence[float], start: int
+    ) -> Tuple[List[float], List[float]]:
+        """Previsão e desvio padrão de ``recommend`` para cada dia a partir de ``start``.
+
+        O elemento ``i`` corresponde ao histórico ``demand[: start + i]``.
+        Toda a série é calculada em uma única passada pela demanda; ver
+        ``_simulate`` sobre a equivalência numérica com ``recommend``.
+        """
+        forecast = self._exp_smoothing_forecast
+        # demand_window=0 usa todo o histórico, como em recommend.
+        window = self.demand_window or None
+        recent = _RollingWindow(window)
+        for value in demand[max(0, start - window) if window else 0 : start]:
+            recent.push(value)
+
+        forecasts: List[float] = []
+        stds: List[float] = []
+        for value in islice(demand, start, None):
+            forecasts.append(forecast(recent.values))
+            stds.append(recent.std())
+            recent.push(value)
+        return forecasts, stds
 
     def recommend(
         self,
@@ -82,21 +191,87 @@ class RetailDecisionAgent:
         inventory_on_order: float,
         lead_time_history: Optional[List[float]] = None,
     ) -> ReplenishmentDecision:
+        lead_hist = lead_time_history or [7.0]
+        lead_estimate = lead_hist[0] if len(lead_hist) == 1 else statistics.mean(lead_hist)
+        return self.recommend_const_lt(
+            demand_history,
+            inventory_on_hand,
+            inventory_on_order,
+            max(1.0, lead_estimate),
+        )
+
+    def recommend_const_lt(
+        self,
+        demand_history: Sequence[float],
+        inventory_on_hand: float,
+        inventory_on_order: float,
+        lead_time: float,
+    ) -> ReplenishmentDecision:
+        """Variante de ``recommend`` para um lead time conhecido (>= 1 dia).
+
+        Dispensa a lista de lead times, a média e o piso de 1 dia.
+        """
+        return self.recommend_fast(
+            demand_history,
+            inventory_on_hand,
+            inventory_on_order,
+            lead_time,
+            math.sqrt(lead_time),
+        )
+
+    def recommend_fast(
+        self,
+        demand_history: Sequence[float],
+        inventory_on_hand: float,
+        inventory_on_order: float,
+        lead_time: float,
+        lead_time_sqrt: float,
+    ) -> ReplenishmentDecision:
+        """Variante de ``recommend`` com lead time já estimado.
+
+        Para chamadas repetidas com o mesmo lead time: ``lead_time`` (>= 1) e
+        ``lead_time_sqrt`` (sua raiz) são calculados uma vez pelo chamador.
+        """
         recent = demand_history[-self.demand_window :] if demand_history else []
-        forecast_daily = self._exp_smoothing_forecast(recent)
-        demand_std = self._recent_std(recent)
+        return self.recommend_window(
+            recent, inventory_on_hand, inventory_on_order, lead_time, lead_time_sqrt
+        )
 
-        lead_hist = lead_time_history or [7.0]
-        lead_time = max(1.0, statistics.mean(lead_hist))
-        z = SERVICE_Z[self.service_level]
+    def recommend_window(
+        self,
+        recent: Sequence[float],
+        inventory_on_hand: float,
+        inventory_on_order: float,
+        lead_time: float,
+        lead_time_sqrt: float,
+    ) -> ReplenishmentDecision:
+        """Como ``recommend_fast``, mas recebendo só a janela recente da demanda.
+
+        ``recent`` deve ter no máximo ``demand_window`` valores (uma fatia,
+        deque ou qualquer sequência); não é recortado de novo.
+        """
+        return self._decide(
+            self._exp_smoothing_forecast(recent),
+            self._recent_std(recent),
+            lead_time,
+            lead_time_sqrt,
+            inventory_on_hand + inventory_on_order,
+        )
 
-        safety_stock = z * demand_std * math.sqrt(lead_time)
+    def _decide(
+        self,
+        forecast_daily: float,
+        demand_std: float,
+        lead_time: float,
+        lead_time_sqrt: float,
+        net_stock: float,
+    ) -> ReplenishmentDecision:
+        safety_stock = self._z * demand_std * lead_time_sqrt
         reorder_point = forecast_daily * lead_time + safety_stock
 
         protection_days = lead_time + self.review_period_days
         target_stock = forecast_daily * protection_days + safety_stock
 
-        net_stock = inventory_on_hand + inventory_on_order
         recommended = max(0.0, target_stock - net_stock)
 
         return ReplenishmentDecision(
@@ -111,78 +286,133 @@ class RetailDecisionAgent:
 
 
 def load_demand_csv(path: Path) -> List[float]:
-    demand: List[float] = []
     with path.open("r", newline="", encoding="utf-8") as f:
-        reader = csv.DictReader(f)
-        if "demand" not in (reader.fieldnames or []):
+        reader = csv.reader(f)
+        header = next(reader, [])
+        if "demand" not in header:
             raise ValueError("CSV precisa ter coluna 'demand'.")
-        for row in reader:
-            demand.append(float(row["demand"]))
+        col = header.index("demand")
+        demand = [float(row[col]) for row in reader if row]
     if len(demand) < 10:
         raise ValueError("CSV precisa ter pelo menos 10 linhas de demanda para validação.")
     return demand
 
 
-def generate_synthetic_demand(days: int = 120, seed: int = 42) -> List[float]:
-    random.seed(seed)
+def spawn_seeds(seed: int, n: int) -> List[int]:
+    """Deriva ``n`` sementes de 64 bits independentes a partir de ``seed``.
+
+    Cada semente alimenta um ``random.Random`` próprio, de modo que as
+    replicações têm fluxos aleatórios distintos e reprodutíveis.
+    """
+    master = random.Random(seed)
+    return [master.getrandbits(64) for _ in range(n)]
+
+
+def generate_synthetic_demand(
+    days: int = 120, seed: int = 42, rng: Optional[random.Random] = None
+) -> List[float]:
+    gauss = (rng or random.Random(seed)).gauss
     base = 22.0
-    output = []
-    for d in range(days):
-        weekly = 4.5 * math.sin(2 * math.pi * d / 7)
-        trend = 0.02 * d
-        noise = random.gauss(0, 3.2)
-        output.append(max(0.0, base + weekly + trend + noise))
-    return output
+    # A sazonalidade semanal tem período 7: basta avaliar o seno uma vez por
+    # dia da semana.
+    weekly = [4.5 * math.sin(2 * math.pi * d / 7) for d in range(7)]
+    return [
+        max(0.0, base + weekly[d % 7] + 0.02 * d + gauss(0, 3.2))
+        for d in range(days)
+    ]
 
 
-def run_validation(
+def _simulate(
     demand: List[float],
+    start: int,
     agent: RetailDecisionAgent,
+    lead_time_days: int,
     initial_inventory: float,
-    lead_time_days: int = 5,
-) -> dict:
+) -> Tuple[int, float, float, int]:
+    """Núcleo da simulação diária da política de reposição.
+
+    Reproduz ``agent.recommend`` dia a dia sem reconstruir o histórico. A
+    política não depende do estoque, só da demanda passada: previsões e
+    desvios padrão vêm de uma passada só (``_rolling_estimates``) e os pontos
+    de pedido e estoques-alvo de todos os dias são calculados antes do laço.
+    O laço diário fica apenas com o estado sequencial (estoque e pedidos em
+    trânsito) e a quantidade pedida, que depende dele. Os pedidos em trânsito
+    ficam em um buffer circular indexado pelo dia de chegada, com o total em
+    trânsito mantido à parte.
+
+    A previsão usa a mesma recorrência de ``recommend`` (mesmos floats). O
+    desvio padrão da janela móvel pode diferir do cálculo em duas passadas por
+    poucos ulps, mas é exatamente zero em janelas constantes, onde um resíduo
+    mudaria o arredondamento do pedido.
+
+    Retorna ``(dias_com_ruptura, falta_total, estoque_acumulado, pedidos)``.
+    """
+    forecasts, stds = agent._rolling_estimates(demand, start)
+    z = agent._z
+    lead_time = max(1.0, lead_time_days)
+    sqrt_lead_time = math.sqrt(lead_time)
+    protection_days = lead_time + agent.review_period_days
+    safety_stocks = [z * demand_std * sqrt_lead_time for demand_std in stds]
+    reorder_points = [f * lead_time + ss for f, ss in zip(forecasts, safety_stocks)]
+    target_stocks = [f * protection_days + ss for f, ss in zip(forecasts, safety_stocks)]
+    ceil = math.ceil
+
     inventory = initial_inventory
-    pipeline: List[tuple[int, int]] = []  # (arrival_day, qty)
+    # arrivals[d % slots] acumula o que chega no dia d. Pedidos com lead time
+    # zero (ou negativo) chegam no dia seguinte, como já assume o ponto de
+    # pedido.
+    arrival_offset = max(0, lead_time_days)
+    slots = arrival_offset + 1
+    arrivals = [0] * slots
+    on_order = 0
 
     stockout_days = 0
     total_shortage = 0.0
     total_holding = 0.0
     placed_orders = 0
 
-    start = max(30, min(45, len(demand) // 3))
-
-    for day in range(start, len(demand)):
-        arrivals = [q for arrival, q in pipeline if arrival == day]
-        if arrivals:
-            inventory += sum(arrivals)
-        pipeline = [(arrival, q) for arrival, q in pipeline if arrival != day]
-
-        history = demand[:day]
-        on_order = sum(q for _, q in pipeline)
-        decision = agent.recommend(
-            demand_history=history,
-            inventory_on_hand=inventory,
-            inventory_on_order=on_order,
-            lead_time_history=[lead_time_days],
-        )
-
-        if inventory + on_order <= decision.reorder_point:
-            qty = decision.recommended_order_qty
+    for day, today_demand, reorder_point, target_stock in zip(
+        range(start, len(demand)), islice(demand, start, None), reorder_points, target_stocks
+    ):
+        slot = day % slots
+        arrived = arrivals[slot]
+        if arrived:
+            arrivals[slot] = 0
+            inventory += arrived
+            on_order -= arrived
+
+        net_stock = inventory + on_order
+        if net_stock <= reorder_point:
+            # Excesso negativo arredonda para qty <= 0: dispensa o max(0, ...).
+            qty = ceil(target_stock - net_stock)
             if qty > 0:
-                pipeline.append((day + lead_time_days, qty))
+                arrivals[(day + arrival_offset) % slots] += qty
+                on_order += qty
                 placed_orders += 1
 
-        today_demand = demand[day]
         if inventory >= today_demand:
             inventory -= today_demand
         else:
-            shortage = today_demand - inventory
-            total_shortage += shortage
+            total_shortage += today_demand - inventory
             stockout_days += 1
             inventory = 0.0
 
         total_holding += inventory
 
+    return stockout_days, total_shortage, total_holding, placed_orders
+
+
+def run_validation(
+    demand: List[float],
+    agent: RetailDecisionAgent,
+    initial_inventory: float,
+    lead_time_days: int = 5,
+) -> dict:
+    start = max(30, min(45, len(demand) // 3))
+    stockout_days, total_shortage, total_holding, placed_orders = _simulate(
+        demand, start, agent, lead_time_days, initial_inventory
+    )
+
     periods = len(demand) - start
     return {
         "periods": periods,
@@ -193,26 +423,152 @@ def run_validation(
     }
 
 
+def resample_weekly_blocks(
+    demand: Sequence[float], rng: random.Random, block: int = 7
+) -> List[float]:
+    """Reamostra ``demand`` em blocos de ``block`` dias (bootstrap em blocos).
+
+    Os blocos começam todos na mesma fase ``offset + block * k`` (``offset``
+    sorteado por replicação), de modo que cada posição da série reamostrada
+    continua no mesmo dia da semana e a dependência entre dias vizinhos é
+    preservada. A série devolvida tem o mesmo tamanho de ``demand``.
+    """
+    n = len(demand)
+    if n <= block:
+        return list(demand)
+    offset = rng.randrange(min(block, n - block + 1))
+    n_blocks = (n - offset) // block
+    output: List[float] = []
+    while len(output) < n:
+        first = offset + block * rng.randrange(n_blocks)
+        output.extend(demand[first : first + block])
+    del output[n:]
+    return output
+
+
+def _one_replication(
+    seed: int,
+    agent: RetailDecisionAgent,
+    days: int,
+    initial_inventory: float,
+    lead_time_days: int,
+    demand: Optional[Sequence[float]],
+    lead_time_jitter: int,
+) -> dict:
+    # Cada replicação recebe o próprio gerador, alimentado pela semente derivada.
+    rng = random.Random(seed)
+    if demand is None:
+        series = generate_synthetic_demand(days=days, rng=rng)
+    else:
+        series = resample_weekly_blocks(demand, rng)
+    if lead_time_jitter:
+        lead_time_days = max(1, lead_time_days + rng.randint(-lead_time_jitter, lead_time_jitter))
+    return run_validation(series, agent, initial_inventory, lead_time_days)
+
+
+def run_validation_mc(
+    agent: RetailDecisionAgent,
+    initial_inventory: float,
+    lead_time_days: int = 5,
+    n_reps: int = 100,
+    n_workers: Optional[int] = None,
+    days: int = 120,
+    seed: int = 42,
+    demand: Optional[Sequence[float]] = None,
+    lead_time_jitter: int = 0,
+) -> dict:
+    """Validação Monte Carlo: repete ``run_validation`` sobre várias realizações.
+
+    Cada replicação tem um gerador próprio, com semente derivada de ``seed``
+    por ``spawn_seeds``. Sem ``demand``, a série da replicação vem de
+    ``generate_synthetic_demand(days)``; com ``demand`` (por exemplo, a série
+    do CSV), ela é uma reamostragem em blocos semanais dessa série
+    (``resample_weekly_blocks``). Com ``lead_time_jitter > 0``, cada
+    replicação sorteia um lead time constante em
+    ``lead_time_days ± lead_time_jitter`` (mínimo de 1 dia). As replicações
+    são distribuídas entre ``n_workers`` processos (padrão: número de CPUs);
+    com ``n_workers=1`` rodam no processo atual.
+    """
+    if lead_time_jitter < 0:
+        raise ValueError("lead_time_jitter não pode ser negativo.")
+    if n_reps < 1:
+        raise ValueError("n_reps precisa ser pelo menos 1.")
+    seeds = spawn_seeds(seed, n_reps)
+    run = partial(
+        _one_replication,
+        agent=agent,
+        days=days,
+        initial_inventory=initial_inventory,
+        lead_time_days=lead_time_days,
+        demand=demand,
+        lead_time_jitter=lead_time_jitter,
+    )
+    if n_workers == 1:
+        results = [run(s) for s in seeds]
+    else:
+        workers = n_workers or os.cpu_count() or 1
+        chunksize = max(1, n_reps // (4 * workers))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(run, seeds, chunksize=chunksize))
+
+    rates = [r["stockout_rate"] for r in results]
+    rate_mean = statistics.mean(rates)
+    rate_std = statistics.stdev(rates) if n_reps > 1 else 0.0
+    half_width = 1.96 * rate_std / math.sqrt(n_reps)
+    return {
+        "replications": n_reps,
+        "stockout_rate_mean": rate_mean,
+        "stockout_rate_std": rate_std,
+        "stockout_rate_ci95": (
+            max(0.0, rate_mean - half_width),
+            min(1.0, rate_mean + half_width),
+        ),
+        "avg_ending_inventory": statistics.mean(r["avg_ending_inventory"] for r in results),
+        "total_shortage_units": statistics.mean(r["total_shortage_units"] for r in results),
+        "orders_placed": statistics.mean(r["orders_placed"] for r in results),
+    }
+
+
 def build_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(description="Agente de reposição para varejo")
     parser.add_argument("--data", type=Path, help="CSV com coluna demand")
     parser.add_argument("--inventory", type=float, default=120.0, help="Estoque atual")
     parser.add_argument("--on-order", type=float, default=20.0, help="Estoque em trânsito")
-    parser.add_argument("--service-level", type=float, default=0.95, choices=sorted(SERVICE_Z))
+    parser.add_argument("--service-level", type=float, default=0.95, help="Nível de serviço (0 a 1)")
     parser.add_argument("--review-period", type=int, default=7)
     parser.add_argument("--lead-time", type=int, default=5)
     parser.add_argument("--validate", action="store_true", help="Executa validação por simulação")
+    parser.add_argument(
+        "--replications",
+        type=int,
+        default=0,
+        help=(
+            "Replicações Monte Carlo (0 desativa): reamostram a série de --data "
+            "em blocos semanais ou, sem --data, usam demanda sintética"
+        ),
+    )
+    parser.add_argument(
+        "--lead-time-jitter",
+        type=int,
+        default=0,
+        help="Variação máxima (dias) do lead time sorteado em cada replicação",
+    )
+    parser.add_argument("--workers", type=int, default=None, help="Processos para as replicações")
     return parser
 
 
 def main() -> None:
-    args = build_parser().parse_args()
+    parser = build_parser()
+    args = parser.parse_args()
     demand = load_demand_csv(args.data) if args.data else generate_synthetic_demand()
 
-    agent = RetailDecisionAgent(
-        service_level=args.service_level,
-        review_period_days=args.review_period,
-    )
+    try:
+        agent = RetailDecisionAgent(
+            service_level=args.service_level,
+            review_period_days=args.review_period,
+        )
+    except ValueError as exc:
+        parser.error(str(exc))
 
     decision = agent.recommend(
         demand_history=demand,
@@ -244,6 +600,28 @@ def main() -> None:
         print(f"Falta acumulada (unid): {metrics['total_shortage_units']:.2f}")
         print(f"Pedidos emitidos: {metrics['orders_placed']}")
 
+    if args.replications > 0:
+        mc = run_validation_mc(
+            agent=agent,
+            initial_inventory=args.inventory,
+            lead_time_days=args.lead_time,
+            n_reps=args.replications,
+            n_workers=args.workers,
+            days=len(demand),
+            demand=demand if args.data else None,
+            lead_time_jitter=args.lead_time_jitter,
+        )
+        low, high = mc["stockout_rate_ci95"]
+        source = "reamostragem do CSV" if args.data else "demanda sintética"
+        print(f"\n=== Validação Monte Carlo ({source}) ===")
+        print(f"Replicações: {mc['replications']}")
+        print(f"Taxa de ruptura média: {mc['stockout_rate_mean']:.2%}")
+        print(f"IC 95% da taxa de ruptura: {low:.2%} a {high:.2%}")
+        print(f"Desvio padrão da taxa de ruptura: {mc['stockout_rate_std']:.2%}")
+        print(f"Estoque médio final: {mc['avg_ending_inventory']:.2f}")
+        print(f"Falta acumulada média (unid): {mc['total_shortage_units']:.2f}")
+        print(f"Pedidos emitidos (média): {mc['orders_placed']:.1f}")
+
 
 if __name__ == "__main__":
     main()